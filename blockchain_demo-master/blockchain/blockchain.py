@@ -1,6 +1,16 @@
+import functools
 import hashlib
 import json
+import logging
+import os
+import orjson
 import requests
+import struct
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+from itertools import repeat
 from urllib.parse import urlparse
 from argparse import ArgumentParser
 from binascii import unhexlify
@@ -8,18 +18,93 @@ from collections import OrderedDict
 from time import time
 from uuid import uuid4
 
-from Crypto.Hash import SHA
-from Crypto.PublicKey import RSA
-from Crypto.Signature import PKCS1_v1_5
 from flask import Flask
+from flask import Response
 from flask import jsonify
 from flask import render_template
 from flask import request
 from flask_cors import CORS
+from nacl.exceptions import BadSignatureError
+from nacl.signing import VerifyKey
+from requests.adapters import HTTPAdapter
 
 MINING_SENDER = 'The Blockchain'
 MINING_REWARD = 1
 MINING_DIFFICULTY = 2
+MINING_CHUNK = 65536
+MINING_WORKERS = os.cpu_count() or 1
+# Checking one block's proof takes ~10 us, but sending a block to a worker
+# costs ~7 us of pickling here plus ~15 ms to start the pool, so a pool only
+# pays off for chains of tens of thousands of blocks on 4 or more cores
+VALIDATION_PARALLEL_BLOCKS = 50000
+VALIDATION_MIN_WORKERS = 4
+NODE_POOL_SIZE = 32
+NODE_TIMEOUT = (1.0, 3.0)  # (connect, read) seconds
+
+# hashlib's OpenSSL-backed SHA-256 dispatches to the SHA-NI instructions at
+# runtime when the CPU supports them, so bind the constructor once here and
+# skip the name lookup that hashlib.new() does on every call
+_sha256 = hashlib.sha256
+_ZERO_PREFIX = bytes(MINING_DIFFICULTY // 2)
+# Nonces are hashed as a fixed-width little-endian tail after the prefix
+_NONCE = struct.Struct('<Q')
+
+
+def _meets_difficulty(digest, difficulty=MINING_DIFFICULTY):
+    """
+    Check that the raw digest starts with difficulty zero hex nibbles
+    """
+    full = difficulty // 2
+    zeros = _ZERO_PREFIX if full == len(_ZERO_PREFIX) else bytes(full)
+    return digest[:full] == zeros and (difficulty & 1 == 0 or digest[full] & 0xF0 == 0)
+
+
+@functools.lru_cache(maxsize=1024)
+def _import_pubkey(pk_hex):
+    """
+    Decode a sender's hex public key into an Ed25519 verify key, once per
+    distinct key while it stays among the most recently used senders
+    """
+    return VerifyKey(unhexlify(pk_hex))
+
+
+def _search_nonces(prefix, difficulty, start):
+    """
+    Return the first nonce in the chunk starting at start that meets
+    difficulty, or None if the chunk has no valid nonce
+    """
+    # Hash the invariant prefix once and resume from that midstate for every
+    # attempt, so each nonce only costs the compression of the final block
+    midstate = _sha256(prefix)
+    # Write each nonce into the same buffer rather than building new bytes
+    tail = bytearray(_NONCE.size)
+    for nonce in range(start, start + MINING_CHUNK):
+        _NONCE.pack_into(tail, 0, nonce)
+        h = midstate.copy()
+        h.update(tail)
+        if _meets_difficulty(h.digest(), difficulty):
+            return nonce
+    return None
+
+
+def _find_nonce(prefix, difficulty=MINING_DIFFICULTY, workers=MINING_WORKERS):
+    """
+    Return the first nonce whose hash together with prefix meets difficulty
+    """
+    # At low difficulty the first chunk almost always holds a valid nonce,
+    # and searching it here is cheaper than starting worker processes
+    nonce = _search_nonces(prefix, difficulty, 0)
+    if nonce is not None:
+        return nonce
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        start = MINING_CHUNK
+        while True:
+            starts = range(start, start + workers * MINING_CHUNK, MINING_CHUNK)
+            # map yields in chunk order, so the first hit is the lowest nonce
+            for nonce in executor.map(_search_nonces, repeat(prefix), repeat(difficulty), starts):
+                if nonce is not None:
+                    return nonce
+            start = starts.stop
 
 
 class Blockchain:
@@ -28,127 +113,233 @@ class Blockchain:
         self.transactions = []
         self.chain = []
         self.nodes = set()
+        # Block hashes of our own chain, kept as a column aligned with self.chain
+        self._chain_hashes = []
+        # Serialized /chain response, rebuilt only after the chain changes
+        self._chain_json_cache = None
+        # Guards transactions, chain and nodes when requests run concurrently
+        self.lock = threading.RLock()
         self.node_id = str(uuid4()).replace('-', '')
+        # host:port this node listens on, when known, so it never polls itself;
+        # set from --port, or from NODE_NETLOC when served by a WSGI server
+        self.netloc = os.environ.get('NODE_NETLOC')
+        # Keep connections to the other nodes alive between consensus rounds
+        self._session = requests.Session()
+        self._session.mount('http://', HTTPAdapter(pool_connections=NODE_POOL_SIZE,
+                                                   pool_maxsize=NODE_POOL_SIZE))
         # Create the genesis block
-        self.create_block(0, '00')
+        self.create_block(0, '00', [])
 
-    def create_block(self, nonce, previous_hash):
+    def create_block(self, nonce, previous_hash, transactions):
         """
-        Add a block of transactions to the blockchain
+        Add a block of the given transactions to the blockchain
         """
-        block = {
-            'block_number': len(self.chain) + 1,
-            'timestamp': time(),
-            'transactions': self.transactions,
-            'nonce': nonce,
-            'previous_hash': previous_hash
-        }
-        # Reset the current list of transactions
-        self.transactions = []
-        self.chain.append(block)
+        with self.lock:
+            block = {
+                'block_number': len(self.chain) + 1,
+                'timestamp': time(),
+                'transactions': transactions,
+                'nonce': nonce,
+                'previous_hash': previous_hash
+            }
+            self.chain.append(block)
+            self._chain_hashes.append(self.hash(block))
+            self._chain_json_cache = None
         return block
 
     @staticmethod
     def verify_transaction_signature(sender_public_key, signature, transaction):
-        public_key = RSA.importKey(unhexlify(sender_public_key))
-        verifier = PKCS1_v1_5.new(public_key)
-        h = SHA.new(str(transaction).encode('utf8'))
         try:
-            verifier.verify(h, unhexlify(signature))
-        except ValueError:
+            _import_pubkey(sender_public_key).verify(str(transaction).encode('utf8'),
+                                                     unhexlify(signature))
+        except (BadSignatureError, ValueError):
             return False
         return True
 
-    def submit_transaction(self, sender_public_key, recipient_public_key, signature, amount):
-        transaction = OrderedDict({
+    @staticmethod
+    def new_transaction(sender_public_key, recipient_public_key, amount):
+        return OrderedDict({
             'sender_public_key': sender_public_key,
             'recipient_public_key': recipient_public_key,
             'amount': amount
         })
+
+    def submit_transaction(self, sender_public_key, recipient_public_key, signature, amount):
+        transaction = self.new_transaction(sender_public_key, recipient_public_key, amount)
         if sender_public_key == MINING_SENDER:
             # Reward for mining the block
-            self.transactions.append(transaction)
-            return len(self.chain) + 1
+            with self.lock:
+                self.transactions.append(transaction)
+                return len(self.chain) + 1
         else:
             # Transaction from wallet to another wallet
             signature_verification = self.verify_transaction_signature(sender_public_key, signature, transaction)
             if signature_verification:
-                self.transactions.append(transaction)
-                return len(self.chain) + 1
+                with self.lock:
+                    self.transactions.append(transaction)
+                    return len(self.chain) + 1
             else:
                 return False
 
     @staticmethod
-    def valid_proof(transactions, last_hash, nonce, difficulty=MINING_DIFFICULTY):
-        guess = (str(transactions) + str(last_hash) + str(nonce)).encode('utf8')
-        h = hashlib.new('sha256')
-        h.update(guess)
-        guess_hash = h.hexdigest()
-        return guess_hash[:difficulty] == '0' * difficulty
-
-    def proof_of_work(self):
-        last_block = self.chain[-1]
-        last_hash = self.hash(last_block)
-        nonce = 0
-        while self.valid_proof(self.transactions, last_hash, nonce) is False:
-            nonce += 1
-        return nonce
+    def proof_prefix(transactions, last_hash):
+        """
+        Encode the part of the proof input that stays fixed while mining
+        """
+        # Encode just the signed fields, in a fixed order, as a JSON array
+        # of rows: canonical without building a sorted dict per transaction
+        rows = [[t['sender_public_key'], t['recipient_public_key'], t['amount']]
+                for t in transactions]
+        transactions_string = json.dumps(rows, separators=(',', ':'))
+        return (transactions_string + str(last_hash)).encode('utf8')
+
+    @staticmethod
+    def valid_proof(prefix, nonce, difficulty=MINING_DIFFICULTY):
+        try:
+            guess = prefix + _NONCE.pack(nonce)
+        except struct.error:
+            # Not a nonce we could have mined, e.g. negative or not an int
+            return False
+        return _meets_difficulty(_sha256(guess).digest(), difficulty)
+
+    def proof_of_work(self, transactions, last_hash):
+        return _find_nonce(self.proof_prefix(transactions, last_hash))
+
+    def mine_block(self):
+        """
+        Mine the pending transactions into a new block, rewarding this node
+        """
+        while True:
+            # Mine a snapshot without holding the lock, so /chain and new
+            # transactions are served while the proof of work runs
+            with self.lock:
+                transactions = list(self.transactions)
+                last_hash = self.last_hash()
+            nonce = self.proof_of_work(transactions, last_hash)
+            with self.lock:
+                if self.last_hash() != last_hash:
+                    # The chain moved on while mining, so the nonce is stale
+                    continue
+                # Reward for mining the block
+                reward = self.new_transaction(MINING_SENDER, self.node_id, MINING_REWARD)
+                block = self.create_block(nonce, last_hash, transactions + [reward])
+                # Transactions are only ever appended, so the ones that arrived
+                # while mining follow the snapshot and wait for the next block
+                self.transactions = self.transactions[len(transactions):]
+                return block
 
     @staticmethod
     def hash(block):
-        block_string = json.dumps(block, sort_keys=True)
-        h = hashlib.new('sha256')
-        h.update(block_string.encode('utf8'))
-        return h.hexdigest()
+        # orjson sorts the keys and returns compact UTF-8 bytes in one call
+        block_bytes = orjson.dumps(block, option=orjson.OPT_SORT_KEYS)
+        return _sha256(block_bytes).hexdigest()
+
+    def last_hash(self):
+        """
+        Look up the hash of the newest block of our own chain
+        """
+        return self._chain_hashes[-1]
 
     def resolve_conflicts(self):
-        neighbours = self.nodes
-        new_chain = None
-        max_length = len(self.chain)
-        for node in neighbours:
-            response = requests.get(f'http://{node}/chain')
-            if response.status_code == 200:
-                resp = response.json()
-                external_length = resp['length']
-                external_chain = resp['chain']
-                if external_length > max_length and self.valid_chain(external_chain):
-                    max_length = external_chain
-                    new_chain = external_chain
-        if new_chain:
-            self.chain = new_chain
-            return True
+        with self.lock:
+            neighbours = [node for node in self.nodes if node != self.netloc]
+            max_length = len(self.chain)
+        new_chain = new_hashes = None
+        if not neighbours:
+            return False
+        # Fetch every neighbour's chain concurrently and check them as they arrive
+        with ThreadPoolExecutor(max_workers=min(len(neighbours), NODE_POOL_SIZE)) as executor:
+            futures = [executor.submit(self._session.get, f'http://{node}/chain', timeout=NODE_TIMEOUT)
+                       for node in neighbours]
+            for future in as_completed(futures):
+                # An unreachable or misbehaving neighbour must not stall consensus,
+                # whether it fails to answer or answers with a malformed chain
+                try:
+                    response = future.result()
+                    if response.status_code != 200:
+                        continue
+                    # Judge a neighbour by the chain it sent, never by the
+                    # length it claims: a liar must not crowd out longer chains
+                    external_chain = response.json()['chain']
+                    external_length = len(external_chain)
+                    if external_length > max_length:
+                        external_hashes = self.validated_hashes(external_chain)
+                        if external_hashes is not None:
+                            max_length = external_length
+                            new_chain, new_hashes = external_chain, external_hashes
+                except (requests.exceptions.RequestException, ValueError,
+                        KeyError, TypeError, IndexError):
+                    continue
+        with self.lock:
+            # Our chain may have grown while the neighbours were being fetched
+            if new_chain and len(new_chain) > len(self.chain):
+                self.chain = new_chain
+                self._chain_hashes = new_hashes
+                self._chain_json_cache = None
+                return True
         return False
 
+    def chain_json(self):
+        """
+        Return the /chain response body, serialized at most once per change
+        """
+        with self.lock:
+            if self._chain_json_cache is None:
+                self._chain_json_cache = orjson.dumps({
+                    'chain': self.chain,
+                    'length': len(self.chain)
+                })
+            return self._chain_json_cache
+
+    @staticmethod
+    def valid_block_proof(block):
+        transactions = block['transactions'][:-1]  # we clear out the reward transaction
+        return Blockchain.valid_proof(Blockchain.proof_prefix(transactions, block['previous_hash']),
+                                      block['nonce'],
+                                      MINING_DIFFICULTY)
+
+    def valid_proofs(self, blocks):
+        # Each block's proof only depends on the block itself, so long chains
+        # are split into one contiguous slice per worker process
+        if len(blocks) < VALIDATION_PARALLEL_BLOCKS or MINING_WORKERS < VALIDATION_MIN_WORKERS:
+            return all(map(self.valid_block_proof, blocks))
+        chunksize = -(-len(blocks) // MINING_WORKERS)
+        with ProcessPoolExecutor(max_workers=MINING_WORKERS) as executor:
+            return all(executor.map(self.valid_block_proof, blocks, chunksize=chunksize))
+
+    def validated_hashes(self, given_chain):
+        """
+        Return the hash column of given_chain, or None if it is not a valid chain
+        """
+        # Hash each block once and check the next block's link against it
+        # straight away, so a broken link stops the sweep early
+        # The last block is hashed too: a chain orjson cannot serialize, e.g.
+        # one holding integers wider than 64 bits, is never adopted
+        try:
+            hashes = [self.hash(given_chain[0])]
+            for block in given_chain[1:]:
+                if block['previous_hash'] != hashes[-1]:
+                    return None
+                hashes.append(self.hash(block))
+        except orjson.JSONEncodeError:
+            return None
+        if not self.valid_proofs(given_chain[1:]):
+            return None
+        return hashes
+
     def valid_chain(self, given_chain):
-        last_block = given_chain[0]
-        current_index = 1
-        while current_index < len(given_chain):
-            block = given_chain[current_index]
-            if block['previous_hash'] != self.hash(last_block):
-                return False
-            transactions = block['transactions'][:-1]  # we clear out the reward transaction
-            transaction_elements = ['sender_public_key',
-                                    'recipient_public_key',
-                                    'amount']
-            transactions = [OrderedDict((k, transaction[k]) for k in transaction_elements)
-                            for transaction in transactions]
-            if not self.valid_proof(transactions,
-                                    block['previous_hash'],
-                                    block['nonce'],
-                                    MINING_DIFFICULTY):
-                return False
-            last_block = block
-            current_index += 1
-        return True
+        return self.validated_hashes(given_chain) is not None
 
     def register_node(self, node_url):
         parsed_url = urlparse(node_url)
         if parsed_url.netloc:
-            self.nodes.add(parsed_url.netloc)
+            node = parsed_url.netloc
         elif parsed_url.path:
-            self.nodes.add(parsed_url.path)
+            node = parsed_url.path
         else:
             raise ValueError('Invalid URL')
+        with self.lock:
+            self.nodes.add(node)
 
 
 blockchain = Blockchain()
@@ -169,48 +360,41 @@ def configure():
 @app.route('/nodes/resolve', methods=['GET'])
 def consensus():
     replaced = blockchain.resolve_conflicts()
+    with blockchain.lock:
+        current_chain = list(blockchain.chain)
 
     if replaced:
         response = {
             'message': 'Our chain was replaced',
-            'new_chain': blockchain.chain
+            'new_chain': current_chain
         }
     else:
         response = {
             'message': 'Our chain is authoritative',
-            'chain': blockchain.chain
+            'chain': current_chain
         }
     return jsonify(response), 200
 
 
 @app.route('/transactions/get', methods=['GET'])
 def transactions_get():
+    with blockchain.lock:
+        transactions = list(blockchain.transactions)
     response = {
-        'transactions': blockchain.transactions
+        'transactions': transactions
     }
     return jsonify(response), 200
 
 
 @app.route('/chain', methods=['GET'])
 def chain():
-    response = {
-        'chain': blockchain.chain,
-        'length': len(blockchain.chain)
-    }
-    return jsonify(response), 200
+    return Response(blockchain.chain_json(), mimetype='application/json'), 200
 
 
 @app.route('/mine', methods=['GET'])
 def mine():
     # Run the proof of work algorithm
-    nonce = blockchain.proof_of_work()
-    blockchain.submit_transaction(sender_public_key=MINING_SENDER,
-                                  recipient_public_key=blockchain.node_id,
-                                  signature='',
-                                  amount=MINING_REWARD)
-    last_block = blockchain.chain[-1]
-    previous_hash = blockchain.hash(last_block)
-    block = blockchain.create_block(nonce, previous_hash)
+    block = blockchain.mine_block()
     response = {
         'message': 'New block created',
         'block_number': block['block_number'],
@@ -223,7 +407,8 @@ def mine():
 
 @app.route('/nodes/get', methods=['GET'])
 def nodes_get():
-    nodes = list(blockchain.nodes)
+    with blockchain.lock:
+        nodes = list(blockchain.nodes)
     response = {
         'nodes': nodes
     }
@@ -238,9 +423,11 @@ def nodes_register():
         return 'Error: Please supply a valid nodes list', 400
     for node in nodes:
         blockchain.register_node(node)
+    with blockchain.lock:
+        total_nodes = list(blockchain.nodes)
     response = {
         'message': 'Nodes have been added',
-        'total_nodes': [node for node in blockchain.nodes]
+        'total_nodes': total_nodes
     }
     return jsonify(response), 200
 
@@ -250,7 +437,9 @@ def transaction_new():
     values = request.form
     required = ['confirmation_sender_public_key', 'confirmation_recipient_public_key',
                 'transaction_signature', 'confirmation_amount']
-    print(values, required)
+    # Only pay for the repr of the form when debug logging is on
+    if app.logger.isEnabledFor(logging.DEBUG):
+        app.logger.debug('tx request: %r', values)
     if not all(k in values for k in required):
         return 'Missing values', 400
     transaction_results = blockchain.submit_transaction(values['confirmation_sender_public_key'],
@@ -271,7 +460,8 @@ if __name__ == '__main__':
                         type=int, help='port to listen to')
     args = parser.parse_args()
     port = args.port
-    app.run(host='127.0.0.1', port=port, debug=True)
+    blockchain.netloc = f'127.0.0.1:{port}'
+    app.run(host='127.0.0.1', port=port)
     
 '''
 Takudzwa Choto, [10/15/2023 1:10 AM]
@@ -0,0 +1,194 @@
+import hashlib
+import json
+import os
+import struct
+import sys
+import threading
+import unittest
+from unittest import mock
+
+import blockchain as node
+from blockchain import Blockchain
+from blockchain import MINING_SENDER
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'blockchain_client'))
+import blockchain_client as wallet  # noqa: E402
+
+
+class NeighbourResponse:
+    """
+    Stand-in for the response to a neighbour's /chain request
+    """
+    status_code = 200
+
+    def __init__(self, body):
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body)
+
+
+def mine_chain(blocks):
+    chain = Blockchain()
+    for _ in range(blocks):
+        chain.submit_transaction(MINING_SENDER, 'recipient', '', 1)
+        chain.mine_block()
+    return chain.chain
+
+
+class ResolveConflictsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.blockchain = Blockchain()
+        self.blockchain.register_node('127.0.0.1:5002')
+
+    def serve(self, chain):
+        body = json.dumps({'chain': chain, 'length': len(chain)})
+        self.blockchain._session.get = lambda url, timeout: NeighbourResponse(body)
+
+    def test_longer_valid_chain_is_adopted(self):
+        self.serve(mine_chain(3))
+        self.assertTrue(self.blockchain.resolve_conflicts())
+        self.assertEqual(len(json.loads(self.blockchain.chain_json())['chain']), 4)
+
+    def test_claimed_length_is_ignored(self):
+        honest = mine_chain(5)
+        bodies = {
+            'http://127.0.0.1:5002/chain': json.dumps({'chain': honest, 'length': len(honest)}),
+            'http://127.0.0.1:5003/chain': json.dumps({'chain': mine_chain(1), 'length': 10 ** 9}),
+            'http://127.0.0.1:5004/chain': json.dumps({'chain': mine_chain(0), 'length': 10 ** 9}),
+        }
+        self.blockchain.register_node('127.0.0.1:5003')
+        self.blockchain.register_node('127.0.0.1:5004')
+        self.blockchain._session.get = lambda url, timeout: NeighbourResponse(bodies[url])
+        self.assertTrue(self.blockchain.resolve_conflicts())
+        self.assertEqual(len(self.blockchain.chain), len(honest))
+
+    def test_unserializable_last_block_is_not_adopted(self):
+        chain = mine_chain(3)
+        # No hash link covers the last block, so only serializing it catches this
+        chain[-1]['timestamp'] = 2 ** 70
+        self.serve(chain)
+        self.assertFalse(self.blockchain.resolve_conflicts())
+        self.assertEqual(len(self.blockchain.chain), 1)
+        self.assertEqual(json.loads(self.blockchain.chain_json())['length'], 1)
+
+    def test_malformed_neighbour_response_is_skipped(self):
+        for body in ['{}', '[]', '{"chain": [], "length": 5}', '{"chain": "x", "length": 5}',
+                     '{"chain": [{}, {}], "length": 5}', '{"chain": [], "length": "5"}']:
+            self.blockchain._session.get = lambda url, timeout, body=body: NeighbourResponse(body)
+            self.assertFalse(self.blockchain.resolve_conflicts(), body)
+
+    def test_own_address_is_not_polled(self):
+        self.blockchain.netloc = '127.0.0.1:5002'
+
+        def get(url, timeout):
+            raise AssertionError(f'polled {url}')
+        self.blockchain._session.get = get
+        self.assertFalse(self.blockchain.resolve_conflicts())
+
+    def test_chain_endpoint_survives_unserializable_neighbour(self):
+        node.blockchain, original = self.blockchain, node.blockchain
+        self.addCleanup(setattr, node, 'blockchain', original)
+        chain = mine_chain(3)
+        chain[-1]['timestamp'] = 2 ** 70
+        self.serve(chain)
+        client = node.app.test_client()
+        self.assertEqual(client.get('/nodes/resolve').status_code, 200)
+        self.assertEqual(client.get('/chain').status_code, 200)
+
+
+class SignatureTest(unittest.TestCase):
+
+    def setUp(self):
+        self.blockchain = Blockchain()
+        client = wallet.app.test_client()
+        self.sender = client.get('/wallet/new').get_json()
+        self.recipient = client.get('/wallet/new').get_json()['public_key']
+        self.signature = wallet.Transaction(self.sender['public_key'], self.sender['private_key'],
+                                            self.recipient, '5').sign_transaction()
+
+    def submit(self, sender_public_key=None, signature=None, amount='5'):
+        return self.blockchain.submit_transaction(sender_public_key or self.sender['public_key'],
+                                                  self.recipient,
+                                                  signature or self.signature,
+                                                  amount)
+
+    def test_wallet_signature_is_accepted(self):
+        self.assertEqual(self.submit(), 2)
+
+    def test_changed_amount_is_rejected(self):
+        self.assertIs(self.submit(amount='6'), False)
+
+    def test_malformed_signature_is_rejected(self):
+        for signature in ['zz', self.signature[:-2], self.signature + '00']:
+            self.assertIs(self.submit(signature=signature), False, signature)
+
+    def test_malformed_public_key_is_rejected(self):
+        for public_key in ['zz', self.sender['public_key'][:-2], self.sender['public_key'] + '00']:
+            self.assertIs(self.submit(sender_public_key=public_key), False, public_key)
+        self.assertEqual(self.blockchain.transactions, [])
+
+
+class MineBlockTest(unittest.TestCase):
+
+    def test_transactions_arriving_while_mining_wait_for_next_block(self):
+        chain = Blockchain()
+        chain.submit_transaction(MINING_SENDER, 'first', '', 1)
+        proof_of_work = chain.proof_of_work
+
+        def submit_while_mining(transactions, last_hash):
+            # From another thread, which would hang if mining held the lock
+            late = threading.Thread(target=chain.submit_transaction,
+                                    args=(MINING_SENDER, 'late', '', 1))
+            late.start()
+            late.join(1)
+            self.assertFalse(late.is_alive())
+            return proof_of_work(transactions, last_hash)
+        chain.proof_of_work = submit_while_mining
+
+        block = chain.mine_block()
+        self.assertEqual([t['recipient_public_key'] for t in block['transactions']],
+                         ['first', chain.node_id])
+        self.assertEqual([t['recipient_public_key'] for t in chain.transactions], ['late'])
+        self.assertTrue(chain.valid_chain(chain.chain))
+
+
+
+class FindNonceTest(unittest.TestCase):
+
+    def test_process_pool_finds_the_lowest_nonce(self):
+        # Chosen so the in-process first chunk has no hit at difficulty 4, and
+        # the two chunks of the first pool round both do
+        prefix = b'parallel-0'
+        nonce = 0
+        while not hashlib.sha256(prefix + struct.pack('<Q', nonce)).hexdigest().startswith('0000'):
+            nonce += 1
+        self.assertGreater(nonce, node.MINING_CHUNK)
+        self.assertEqual(node._find_nonce(prefix, 4, workers=2), nonce)
+
+
+
+class ValidProofsTest(unittest.TestCase):
+
+    def setUp(self):
+        # Force the process pool even for a short chain on a small machine
+        for name, value in [('VALIDATION_PARALLEL_BLOCKS', 2),
+                            ('VALIDATION_MIN_WORKERS', 2),
+                            ('MINING_WORKERS', 2)]:
+            patcher = mock.patch.object(node, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.blockchain = Blockchain()
+        self.chain = json.loads(json.dumps(mine_chain(5)))
+
+    def test_valid_chain_passes_in_worker_processes(self):
+        self.assertTrue(self.blockchain.valid_proofs(self.chain[1:]))
+
+    def test_bad_proof_fails_in_worker_processes(self):
+        self.chain[3]['transactions'][0]['amount'] = 2
+        self.assertFalse(self.blockchain.valid_proofs(self.chain[1:]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,15 +2,11 @@ import binascii
 from argparse import ArgumentParser
 from collections import OrderedDict
 
-import Crypto
-import Crypto.Random
-from Crypto.Hash import SHA
-from Crypto.PublicKey import RSA
-from Crypto.Signature import PKCS1_v1_5
 from flask import Flask
 from flask import jsonify
 from flask import render_template
 from flask import request
+from nacl.signing import SigningKey
 
 class Transaction:
     def __init__(self, sender_public_key, sender_private_key,
@@ -28,10 +24,9 @@ class Transaction:
         })
 
     def sign_transaction(self):
-        private_key = RSA.importKey(binascii.unhexlify(self.sender_private_key))
-        signer = PKCS1_v1_5.new(private_key)
-        my_hash = SHA.new(str(self.to_dict()).encode('utf8'))
-        return binascii.hexlify(signer.sign(my_hash)).decode('ascii')
+        private_key = SigningKey(binascii.unhexlify(self.sender_private_key))
+        signed = private_key.sign(str(self.to_dict()).encode('utf8'))
+        return binascii.hexlify(signed.signature).decode('ascii')
 
 
 app = Flask(__name__)
@@ -69,12 +64,11 @@ def view_transactions():
 
 @app.route('/wallet/new')
 def new_wallet():
-    random_gen = Crypto.Random.new().read
-    private_key = RSA.generate(1024, random_gen)
-    public_key = private_key.publickey()
+    private_key = SigningKey.generate()
+    public_key = private_key.verify_key
     response = {
-        'private_key': binascii.hexlify(private_key.export_key(format('DER'))).decode('ascii'),
-        'public_key': binascii.hexlify(public_key.export_key(format('DER'))).decode('ascii')
+        'private_key': binascii.hexlify(bytes(private_key)).decode('ascii'),
+        'public_key': binascii.hexlify(bytes(public_key)).decode('ascii')
     }
     return jsonify(response), 200
 